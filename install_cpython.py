@@ -1,12 +1,46 @@
 #!/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import enum
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
 import subprocess
 import sys
-from typing import List, Tuple, Optional
-
-from semantic_version import Version
+import tempfile
+import time
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
+
+
+CONFIGURE_FLAGS = ['--enable-optimizations']
+DEBIAN_PACKAGES = ['build-essential', 'gdb', 'lcov', 'libbz2-dev', 'libffi-dev', 'libgdbm-dev', 'liblzma-dev',
+                   'libncurses5-dev', 'libreadline6-dev', 'libsqlite3-dev', 'libssl-dev', 'lzma', 'lzma-dev', 'tk-dev',
+                   'uuid-dev', 'zlib1g-dev']
+APT_UPDATE_STAMP = '/var/lib/apt/periodic/update-success-stamp'
+APT_UPDATE_MAX_AGE_HOURS = 24
+# `git sparse-checkout` needs 2.25 and `git switch --discard-changes` 2.23; `make --output-sync` needs GNU make 4.0:
+MIN_GIT_VERSION = (2, 25)
+MIN_GIT_VERSION_FULL_CHECKOUT = (2, 23)
+MIN_MAKE_VERSION = (4, 0)
+OUTPUT_TAIL_LINES = 500
+RESOLVE_CHUNK_SIZE = 256
+INSTALL_PREFIX = '/usr/local'
+# Everything but the documentation sources and the Windows build files. Lib/test has to stay, as the profile-guided
+# optimization build runs the test suite:
+SPARSE_CHECKOUT_PATTERNS = ['/*', '!/Doc/', '!/PCbuild/']
+
+_VERSION_RE = re.compile(r'v?(\d+)\.(\d+)\.(\d+)(?:(a|b|c|rc)(\d+))?$')
+_PRERELEASE_RANKS = {'a': 0, 'b': 1, 'c': 2, 'rc': 2, None: 3}
+
+# (major, minor, patch, prerelease rank, prerelease number)
+VersionTuple = Tuple[int, int, int, int, int]
 
 
 class DistroLike(enum.Enum):
@@ -14,129 +48,422 @@ class DistroLike(enum.Enum):
     RedHatFedora = "rhel fedora"
 
 
+def _parse_os_release(path: str = '/etc/os-release') -> Iterator[Tuple[str, str]]:
+    with open(path) as f:
+        for line in f:
+            if '=' not in line:
+                continue
+            key, _, value = line.partition('=')
+            yield key.strip(), value.strip().strip('"').strip("'")
+
+
 def detect_distro_like() -> DistroLike:
-    target_prefix = "ID_LIKE="
-    with open('/etc/os-release') as f:
-        os_release = [line[len(target_prefix):] for line in f.read().split() if line[:len(target_prefix)] == target_prefix]
-    if len(os_release) != 1:
-        raise ValueError("Unexpected format of /etc/os-release")
-    distro_like = os_release.pop()
+    distro_like = dict(_parse_os_release()).get('ID_LIKE')
+    if distro_like is None:
+        raise ValueError("No ID_LIKE entry in /etc/os-release")
     try:
         return DistroLike(distro_like)
     except ValueError:
         raise ValueError(f'Unsupported distro: {distro_like}')
 
 
+def apt_lists_are_fresh(max_age_hours: float = APT_UPDATE_MAX_AGE_HOURS) -> bool:
+    try:
+        last_update = os.stat(APT_UPDATE_STAMP).st_mtime
+    except FileNotFoundError:
+        return False
+    return time.time() - last_update < max_age_hours * 60 * 60
+
+
+def get_apt_build_deps(source_package: str) -> List[str]:
+    # Simulating the build-dep lists the packages it would install without taking the dpkg lock:
+    try:
+        out = subprocess.check_output(['apt-get', 'build-dep', '-s', source_package], stderr=subprocess.STDOUT,
+                                      text=True)
+    except subprocess.CalledProcessError as e:
+        print(f"{e.returncode}")
+        print(e.output, file=sys.stderr)
+        raise OSError() from e
+    return [line.split()[1] for line in out.splitlines() if line.startswith('Inst ')]
+
+
 def install_system_dependencies(distro_like: DistroLike) -> None:
     if distro_like == DistroLike.Debian:
-        safe_run_process("apt update")
-        safe_run_process("apt build-dep -y python3")
-        safe_run_process("apt install -y build-essential gdb lcov libbz2-dev libffi-dev libgdbm-dev liblzma-dev "
-                         "libncurses5-dev libreadline6-dev libsqlite3-dev libssl-dev lzma lzma-dev tk-dev uuid-dev zlib1g-dev")
+        if apt_lists_are_fresh():
+            print(">>> Skipping apt update")
+        else:
+            safe_run_process(['apt-get', 'update'])
+        safe_run_process(['apt-get', 'install', '-y', '--no-install-recommends', *get_apt_build_deps('python3'),
+                          *DEBIAN_PACKAGES])
     elif distro_like == DistroLike.RedHatFedora:
         # TODO: test this on a centos box
-        safe_run_process("yum install -y yum-utils")
-        safe_run_process("yum-builddep -y python3")
+        if shutil.which('dnf') is not None:
+            safe_run_process(['dnf', 'install', '-y', '--setopt=install_weak_deps=False', 'dnf-plugins-core'])
+            safe_run_process(['dnf', 'builddep', '-y', '--setopt=install_weak_deps=False', 'python3'])
+        else:
+            safe_run_process(['yum', 'install', '-y', 'yum-utils'])
+            safe_run_process(['yum-builddep', '-y', 'python3'])
     else:
         raise ValueError(f"Unsupported distro: {distro_like}")
 
 
-def get_versions(cpython_repo_dir: str) -> List[str]:
-    return subprocess.check_output(f'git tag'.split(), cwd=cpython_repo_dir).decode().split()
-
-
-def safe_parse_version(version_str: str) -> Optional[Version]:
+class GitSession:
+    def __init__(self, cpython_repo_dir: str):
+        self._proc = subprocess.Popen(['git', 'cat-file', '--batch-check'], cwd=cpython_repo_dir,
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def resolve(self, ref: str) -> Optional[str]:
+        self._proc.stdin.write(f'{ref}\n')
+        self._proc.stdin.flush()
+        fields = self._proc.stdout.readline().split()
+        if len(fields) != 3:
+            # `<ref> missing` or `<ref> ambiguous`
+            return None
+        return fields[0]
+
+    def resolve_all(self, refs: Iterable[str]) -> Dict[str, Optional[str]]:
+        # Refs are sent in chunks, reading back each chunk's answers before sending the next one, so that neither
+        # pipe can fill up while the other side waits on it:
+        refs = list(refs)
+        resolved = {}
+        for start in range(0, len(refs), RESOLVE_CHUNK_SIZE):
+            chunk = refs[start:start + RESOLVE_CHUNK_SIZE]
+            self._proc.stdin.write(''.join(f'{ref}\n' for ref in chunk))
+            self._proc.stdin.flush()
+            for ref in chunk:
+                fields = self._proc.stdout.readline().split()
+                resolved[ref] = fields[0] if len(fields) == 3 else None
+        return resolved
+
+    def close(self) -> None:
+        self._proc.stdin.close()
+        self._proc.wait()
+
+    def __enter__(self) -> 'GitSession':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _read_head_ref(cpython_repo_dir: str) -> Optional[str]:
+    # Worktrees and submodules have a `.git` file instead of a directory, and packed refs and reftable repositories
+    # have no file per ref; return None in those cases and leave it to git:
+    git_dir = os.path.join(cpython_repo_dir, '.git')
+    if not os.path.isdir(git_dir):
+        return None
+    with open(os.path.join(git_dir, 'HEAD')) as f:
+        head = f.read().strip()
+    if not head.startswith('ref: '):
+        return head
     try:
-        return Version(version_str)
-    except ValueError:
+        with open(os.path.join(git_dir, head[len('ref: '):])) as f:
+            return f.read().strip()
+    except OSError:
         return None
 
 
-def normalize_version(version_tag) -> Tuple[str, Version]:
-    if version_tag[0] == 'v':
-        return version_tag, safe_parse_version(version_tag[1:])
-    else:
-        return version_tag, safe_parse_version(version_tag)
+def get_head_ref(cpython_repo_dir: str, git_session: GitSession) -> Optional[str]:
+    head_ref = _read_head_ref(cpython_repo_dir)
+    if head_ref is None:
+        head_ref = git_session.resolve('HEAD')
+    return head_ref
+
 
+def get_versions(cpython_repo_dir: str) -> Iterator[str]:
+    proc = subprocess.Popen(['git', 'for-each-ref', '--format=%(refname:lstrip=2)', 'refs/tags/v*'],
+                            cwd=cpython_repo_dir, stdout=subprocess.PIPE)
+    with proc:
+        for line in proc.stdout:
+            yield line.decode().rstrip()
+    if proc.returncode != 0:
+        raise OSError(f"git for-each-ref exited with {proc.returncode}")
 
-def get_latest_minor_versions(versions: List[str]):
-    # Drop the leading 'v' and parse where possible:
-    versions = [normalize_version(ver) for ver in versions]
-    versions = [(version_str, version) for version_str, version in versions if version is not None]
 
-    # Group by minor version:
-    versions_by_minor_version = {f'{version.major}.{version.minor}': [] for version_tag, version in versions}
-    for version_tag, version in versions:
-        versions_by_minor_version[f'{version.major}.{version.minor}'].append((version_tag, version))
+@functools.lru_cache(maxsize=None)
+def parse_version(version_str: str) -> Optional[VersionTuple]:
+    # CPython tags are `[v]MAJOR.MINOR.PATCH[{a,b,c,rc}N]`, parsed into tuples that compare in release order:
+    match = _VERSION_RE.match(version_str)
+    if match is None:
+        return None
+    major, minor, patch, prerelease, prerelease_number = match.groups()
+    return (int(major), int(minor), int(patch), _PRERELEASE_RANKS[prerelease],
+            int(prerelease_number) if prerelease_number else 0)
 
-    # Get maximum:
-    latest_minor_versions = [max(versions, key=lambda x: x[1]) for _, versions in versions_by_minor_version.items()]
 
-    return latest_minor_versions
+def is_prerelease(version: VersionTuple) -> bool:
+    return version[3] != _PRERELEASE_RANKS[None]
 
 
-def safe_run_process(cmd: str, cwd: Optional[str] = None):
-    proc = subprocess.Popen(cmd.split(), cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+def get_latest_minor_versions(versions: Iterable[str], minimum_version: Optional[VersionTuple] = None,
+                              maximum_version: Optional[VersionTuple] = None) -> List[Tuple[str, VersionTuple]]:
+    # Keep only the latest final release within the bounds for each minor version, in a single pass:
+    latest_minor_versions = {}
+    for version_tag in versions:
+        version = parse_version(version_tag)
+        if version is None:
+            continue
+        if is_prerelease(version):
+            continue
+        if minimum_version is not None and version < minimum_version:
+            continue
+        if maximum_version is not None and version > maximum_version:
+            continue
+        minor_version = version[:2]
+        latest = latest_minor_versions.get(minor_version)
+        if latest is None or version > latest[1]:
+            latest_minor_versions[minor_version] = (version_tag, version)
+
+    return list(latest_minor_versions.values())
+
+
+def safe_run_process(cmd: List[str], cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None):
+    # Output is streamed as it comes, keeping only its tail around to repeat on failure:
+    tail = collections.deque(maxlen=OUTPUT_TAIL_LINES)
+    with subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1,
+                          text=True, errors='replace') as proc:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            tail.append(line)
     if proc.returncode != 0:
         print(f"{proc.returncode}")
-        print(out.decode(), file=sys.stdout)
-        print(err.decode(), file=sys.stderr)
+        print(''.join(tail), file=sys.stderr)
         raise OSError()
 
 
-if __name__ == '__main__':
-    # TODO(TK): README; push to github
+def get_worktree_dir(cpython_repo_dir: str, minor_version: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(cpython_repo_dir)), f'wt-{minor_version}')
+
+
+def get_build_dir(cpython_repo_dir: str, minor_version: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(cpython_repo_dir)), f'build-{minor_version}')
+
+
+def is_sparse_checkout(worktree_dir: str) -> bool:
+    proc = subprocess.run(['git', 'config', '--bool', 'core.sparseCheckout'], cwd=worktree_dir,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return proc.stdout.strip() == 'true'
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--cpython_repo_dir', '-d', type=str, required=True)
-    parser.add_argument('--minimum_python_version', '--min', type=str, default='3.0.0')
-    parser.add_argument('--maximum_python_version', '--max', type=str, default=None, required=False)
-    parser.add_argument('--pull', action='store_true')
-    args = parser.parse_args()
 
-    versions = get_versions(cpython_repo_dir=args.cpython_repo_dir)
-    versions = get_latest_minor_versions(versions)
-    if args.minimum_python_version is not None:
-        versions = [(version_tag, version) for version_tag, version in versions if version >= Version(args.minimum_python_version)]
-    if args.maximum_python_version is not None:
-        versions = [(version_tag, version) for version_tag, version in versions if version <= Version(args.maximum_python_version)]
-    version_tags = [version_tag for version_tag, version in versions]
-
-    initial_ref = subprocess.check_output('git rev-parse HEAD'.split(), cwd=args.cpython_repo_dir).decode().strip()
-    print(f">>> Initial ref: {initial_ref}")
-
-    # Detect distro and install system dependencies:
-    print(">>> Installing system dependencies")
-    distro_like = detect_distro_like()
-    install_system_dependencies(distro_like)
-
-    if args.pull:
-        print(">>> Pulling")
-        safe_run_process(cmd='git pull', cwd=args.cpython_repo_dir)
+def set_sparse_checkout(worktree_dir: str, full_checkout: bool) -> None:
+    if full_checkout:
+        # Only touch sparse checkout when it is in use, so that the opt-out does not depend on `git sparse-checkout`:
+        if is_sparse_checkout(worktree_dir):
+            safe_run_process(cmd=['git', 'sparse-checkout', 'disable'], cwd=worktree_dir)
     else:
-        print(">>> Skipping pulling")
+        # `set --no-cone` needs git 2.35, while `init --no-cone` followed by `set` also works with older releases:
+        safe_run_process(cmd=['git', 'sparse-checkout', 'init', '--no-cone'], cwd=worktree_dir)
+        safe_run_process(cmd=['git', 'sparse-checkout', 'set', *SPARSE_CHECKOUT_PATTERNS], cwd=worktree_dir)
+
+
+def prepare_worktree(cpython_repo_dir: str, minor_version: str, version_tag: str, full_checkout: bool = False) -> str:
+    # Worktrees are kept between runs, one per minor version, and moved to the latest tag of that minor version:
+    worktree_dir = get_worktree_dir(cpython_repo_dir, minor_version)
+    if os.path.isdir(worktree_dir):
+        safe_run_process(cmd=['git', 'clean', '-xfdq'], cwd=worktree_dir)
+        set_sparse_checkout(worktree_dir, full_checkout)
+        safe_run_process(cmd=['git', 'switch', '--detach', '--discard-changes', '--quiet', version_tag], cwd=worktree_dir)
+    else:
+        # Set up the sparse checkout before any files are written:
+        safe_run_process(cmd=['git', 'worktree', 'add', '--detach', '--no-checkout', worktree_dir, version_tag],
+                         cwd=cpython_repo_dir)
+        set_sparse_checkout(worktree_dir, full_checkout)
+        safe_run_process(cmd=['git', 'reset', '--hard', '--quiet'], cwd=worktree_dir)
+    return worktree_dir
+
+
+def get_build_env(make_jobs: Optional[int] = None) -> Dict[str, str]:
+    env = dict(os.environ)
+    if shutil.which('ccache') is not None:
+        # Wrap whichever compiler the user picked rather than replacing it:
+        compiler = env.get('CC') or 'gcc'
+        if not compiler.startswith('ccache'):
+            env['CC'] = f'ccache {compiler}'
+        env.setdefault('CCACHE_DIR', os.path.join(os.path.expanduser('~'), '.ccache'))
+    if make_jobs is not None:
+        # Keep the output of each recipe together, as parallel recipes would otherwise interleave:
+        env['MAKEFLAGS'] = f'-j{make_jobs} --output-sync=target'
+    return env
+
+
+def get_manifest_path() -> str:
+    return os.path.join(os.path.expanduser('~'), '.cache', 'install_cpython', 'manifest.json')
+
+
+def load_manifest() -> Dict[str, str]:
+    # A missing or unreadable manifest only means that every version gets built again:
+    try:
+        with open(get_manifest_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: Dict[str, str]) -> None:
+    # Write to a temporary file and move it into place, so that an interrupted run cannot leave a truncated manifest:
+    manifest_dir = os.path.dirname(get_manifest_path())
+    os.makedirs(manifest_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=manifest_dir, suffix='.tmp', delete=False) as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f.name, get_manifest_path())
+
+
+def get_build_key(sha: str) -> str:
+    # A version needs rebuilding when either the commit behind its tag or the configure flags change:
+    return hashlib.sha1(f"{sha}:{' '.join(CONFIGURE_FLAGS)}".encode()).hexdigest()
+
+
+def configure_one(version_tag: str, worktree_dir: str, build_dir: str) -> None:
+    os.makedirs(build_dir, exist_ok=True)
 
-    for version_tag in sorted(version_tags, reverse=True):
+    # The build directory is kept between runs, so only configure it the first time around. When a newer tag changes
+    # configure, the generated Makefile reruns it by itself:
+    if os.path.exists(os.path.join(build_dir, 'Makefile')):
+        print(f">>> Skipping configuring {version_tag}")
+    else:
+        print(f">>> Configuring {version_tag}")
+        safe_run_process(cmd=[os.path.join(worktree_dir, 'configure'), *CONFIGURE_FLAGS], cwd=build_dir,
+                         env=get_build_env())
+
+
+@contextlib.contextmanager
+def install_lock() -> Iterator[None]:
+    # Parallel builds all install into the same prefix, so only one of them may install at a time:
+    with open(os.path.join(INSTALL_PREFIX, '.install.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
         try:
-            print(f">>> Getting {version_tag}")
-            safe_run_process(cmd=f'git add -A', cwd=args.cpython_repo_dir)
-            safe_run_process(cmd=f'git reset --hard', cwd=args.cpython_repo_dir)
-            safe_run_process(cmd=f'git checkout {version_tag}', cwd=args.cpython_repo_dir)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-            print(f">>> Configuring {version_tag}")
-            safe_run_process(cmd=f'./configure --enable-optimizations', cwd=args.cpython_repo_dir)
 
-            print(f">>> Cleaning {version_tag}")
-            safe_run_process(cmd=f'make clean', cwd=args.cpython_repo_dir)
+def make_one(version_tag: str, build_dir: str, make_jobs: int) -> None:
+    # The profiling run of an optimized build is skipped while its stamp exists, whatever the sources, so drop the
+    # stamp left behind by the previous build in this directory:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(build_dir, 'profile-run-stamp'))
 
-            print(f">>> Making {version_tag}")
-            safe_run_process(cmd=f'make -j', cwd=args.cpython_repo_dir)
+    print(f">>> Making {version_tag}")
+    safe_run_process(cmd=['make'], cwd=build_dir, env=get_build_env(make_jobs))
 
-            print(f">>> Installing {version_tag}")
-            safe_run_process(cmd=f'make altinstall', cwd=args.cpython_repo_dir)
-        except OSError:
-            continue
+    with install_lock():
+        print(f">>> Installing {version_tag}")
+        safe_run_process(cmd=['make', 'altinstall'], cwd=build_dir, env=get_build_env())
+
+
+def get_tool_version(cmd: List[str], banner: str) -> Optional[Tuple[int, int]]:
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    except OSError:
+        return None
+    match = re.search(rf'{banner} (\d+)\.(\d+)', out)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def check_tool_version(name: str, cmd: List[str], banner: str, minimum: Tuple[int, int]) -> None:
+    version = get_tool_version(cmd, banner)
+    if version is None or version < minimum:
+        found = '.'.join(map(str, version)) if version is not None else 'none'
+        sys.exit(f"{name} {'.'.join(map(str, minimum))} or newer is required (found: {found})")
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return number
+
+
+if __name__ == '__main__':
+    # TODO(TK): README; push to github
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cpython_repo_dir', '-d', type=str, required=True)
+    parser.add_argument('--minimum_python_version', '--min', type=str, default='3.0.0')
+    parser.add_argument('--maximum_python_version', '--max', type=str, default=None, required=False)
+    parser.add_argument('--pull', action='store_true')
+    parser.add_argument('--jobs', '-j', type=positive_int, default=1, help='Number of versions to build concurrently')
+    parser.add_argument('--make-jobs', type=positive_int, default=None,
+                        help='Number of make jobs per version (default: CPU count divided by --jobs)')
+    parser.add_argument('--full-checkout', action='store_true',
+                        help='Check out the whole source tree instead of only what the build needs')
+    parser.add_argument('--force', action='store_true', help='Rebuild versions even if they were already installed')
+    args = parser.parse_args()
 
-    print(f">>> Restoring head to {initial_ref}")
-    subprocess.check_output(f'git checkout {initial_ref}'.split(), cwd=args.cpython_repo_dir)
+    check_tool_version('git', ['git', '--version'], 'git version',
+                       MIN_GIT_VERSION_FULL_CHECKOUT if args.full_checkout else MIN_GIT_VERSION)
+
+    minimum_version = parse_version(args.minimum_python_version) if args.minimum_python_version else None
+    if args.minimum_python_version and minimum_version is None:
+        parser.error(f"Invalid minimum version: {args.minimum_python_version}")
+    maximum_version = parse_version(args.maximum_python_version) if args.maximum_python_version else None
+    if args.maximum_python_version and maximum_version is None:
+        parser.error(f"Invalid maximum version: {args.maximum_python_version}")
+    with GitSession(args.cpython_repo_dir) as git_session:
+        versions = get_versions(cpython_repo_dir=args.cpython_repo_dir)
+        versions = get_latest_minor_versions(versions, minimum_version, maximum_version)
+
+        initial_ref = get_head_ref(args.cpython_repo_dir, git_session)
+        print(f">>> Initial ref: {initial_ref}")
+
+        # Detect distro and install system dependencies, pulling at the same time since both mostly wait on the network:
+        distro_like = detect_distro_like()
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            print(">>> Installing system dependencies")
+            setup_futures = [executor.submit(install_system_dependencies, distro_like)]
+            if args.pull:
+                print(">>> Pulling")
+                setup_futures.append(executor.submit(safe_run_process, cmd=['git', 'pull'], cwd=args.cpython_repo_dir))
+            else:
+                print(">>> Skipping pulling")
+        for future in setup_futures:
+            future.result()
+
+        # make is only guaranteed to be there once the system dependencies are installed:
+        check_tool_version('GNU make', ['make', '--version'], 'GNU Make', MIN_MAKE_VERSION)
+
+        manifest = load_manifest()
+        # Resolve the commits behind all tags in one round trip:
+        commit_refs = {version_tag: f'{version_tag}^{{commit}}' for version_tag, _ in versions}
+        shas = git_session.resolve_all(commit_refs.values())
+        build_keys = {version_tag: get_build_key(shas[ref]) if shas[ref] is not None else None
+                      for version_tag, ref in commit_refs.items()}
+
+        # Each minor version gets its own worktree and build directory, so that builds can run side by side and the
+        # next patch release of a minor version starts from the previous one's configuration. Checkout and configure
+        # are mostly single-threaded, so they run here one version at a time while the workers compile the versions
+        # that are already configured:
+        # Forget worktrees whose directories were deleted since the last run, so that they can be added again:
+        safe_run_process(cmd=['git', 'worktree', 'prune'], cwd=args.cpython_repo_dir)
+        make_jobs = args.make_jobs if args.make_jobs is not None else max(1, (os.cpu_count() or 1) // args.jobs)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {}
+            for version_tag, version in sorted(versions, key=lambda x: x[1], reverse=True):
+                build_key = build_keys[version_tag]
+                if not args.force and build_key is not None and manifest.get(version_tag) == build_key:
+                    print(f">>> Skipping {version_tag}, already installed")
+                    continue
+                minor_version = f'{version[0]}.{version[1]}'
+                build_dir = get_build_dir(args.cpython_repo_dir, minor_version)
+                try:
+                    print(f">>> Getting {version_tag}")
+                    worktree_dir = prepare_worktree(args.cpython_repo_dir, minor_version, version_tag,
+                                                    args.full_checkout)
+                    configure_one(version_tag, worktree_dir, build_dir)
+                except OSError:
+                    print(f">>> Failed to build {version_tag}")
+                    continue
+                futures[executor.submit(make_one, version_tag, build_dir, make_jobs)] = version_tag
+
+            for future in concurrent.futures.as_completed(futures):
+                version_tag = futures[future]
+                try:
+                    future.result()
+                except OSError:
+                    print(f">>> Failed to build {version_tag}")
+                    continue
+                if build_keys[version_tag] is not None:
+                    manifest[version_tag] = build_keys[version_tag]
+                    save_manifest(manifest)